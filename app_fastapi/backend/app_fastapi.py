@@ -1,32 +1,25 @@
-import os
-import fastapi
-import routes
-
-import io
-import json
 import logging
-import mimetypes
-import time
-from pathlib import Path
-from typing import AsyncGenerator
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 import aiohttp
+import fastapi
 import openai
-from azure.core.exceptions import ResourceNotFoundError
+import orjson
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.identity.aio import DefaultAzureCredential
-from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import BlobServiceClient
-from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
-from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
-
+from fastapi.responses import ORJSONResponse
+from fastapi.staticfiles import StaticFiles
 
+import routes
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
 from core.authentication import AuthenticationHelper
+from tokenmanager import TokenManager
 
-from fastapi import FastAPI, Request, HTTPException, Query, UploadFile, File, Body
-from fastapi.staticfiles import StaticFiles
 
 def create_app():
     # Check for an environment variable that's only set in production
@@ -35,9 +28,26 @@ def create_app():
             servers=[{"url": "/api", "description": "API"}],
             root_path="/public",
             root_path_in_servers=False,
+            default_response_class=ORJSONResponse,
         )
     else:
-        app = fastapi.FastAPI()
+        app = fastapi.FastAPI(default_response_class=ORJSONResponse)
+
+    # Level should be one of https://docs.python.org/3/library/logging.html#logging-levels
+    default_level = "INFO"  # In development, log more verbosely
+    if os.getenv("WEBSITE_HOSTNAME"):  # In production, don't log as heavily
+        default_level = "WARNING"
+    # Log records are put on a queue and written out by a listener thread, so the event loop
+    # never blocks on writing log output
+    log_queue: queue.Queue = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    logging.basicConfig(level=os.getenv("APP_LOG_LEVEL", default_level), handlers=[queue_handler])
+    # basicConfig does nothing if the root logger is already configured (e.g. by an earlier create_app call),
+    # in which case there is nothing for a listener to consume
+    log_listener = None
+    if queue_handler in logging.getLogger().handlers:
+        log_listener = QueueListener(log_queue, logging.StreamHandler(), respect_handler_level=True)
+        log_listener.start()
 
     async def setup_clients():
         AZURE_STORAGE_ACCOUNT = os.environ["AZURE_STORAGE_ACCOUNT"]
@@ -85,83 +95,122 @@ def create_app():
         )
 
         # Set up clients for AI Search and Storage
-        search_client = SearchClient(
-            endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-            index_name=AZURE_SEARCH_INDEX,
-            credential=azure_credential,
+        # They are only created on first use (see routes.get_state_client), so endpoints that never touch them
+        # don't pay for them. Both share one aiohttp session with a larger connection pool and longer keep-alive
+        # than the SDK defaults, so concurrent searches and /content downloads don't queue up waiting for a connection
+        azure_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=128, limit_per_host=64, keepalive_timeout=60)
         )
-        blob_client = BlobServiceClient(
-            account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
-        )
-        blob_container_client = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+        setattr(app.state, routes.CONFIG_AZURE_SESSION, azure_session)
+
+        async def create_search_client():
+            return SearchClient(
+                endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+                index_name=AZURE_SEARCH_INDEX,
+                credential=azure_credential,
+                transport=AioHttpTransport(session=azure_session, session_owner=False),
+            )
 
-        # Used by the OpenAI SDK
+        async def create_blob_container_client():
+            blob_client = BlobServiceClient(
+                account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+                credential=azure_credential,
+                transport=AioHttpTransport(session=azure_session, session_owner=False),
+            )
+            return blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+
+        # Used by the OpenAI SDK, shared across requests so connections to the OpenAI endpoint are kept alive
+        openai_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60))
+        setattr(app.state, routes.CONFIG_OPENAI_SESSION, openai_session)
         if OPENAI_HOST == "azure":
             openai.api_type = "azure_ad"
             openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
             openai.api_version = "2023-07-01-preview"
-            openai_token = await azure_credential.get_token("https://cognitiveservices.azure.com/.default")
-            openai.api_key = openai_token.token
-            # Store on app.config for later use inside requests
-            setattr(app.state, routes.CONFIG_OPENAI_TOKEN, openai_token)
+            openai_token_manager = TokenManager(
+                azure_credential,
+                "https://cognitiveservices.azure.com/.default",
+                on_refresh=lambda token: setattr(openai, "api_key", token),
+            )
+            # Fetch the first token in the background instead of blocking startup on it,
+            # requests that arrive before it is ready wait for that same fetch
+            openai_token_manager.start_auto_refresh()
+            # Store on app.state for later use inside requests
+            setattr(app.state, routes.CONFIG_OPENAI_TOKEN_MANAGER, openai_token_manager)
 
         else:
             openai.api_type = "openai"
             openai.api_key = OPENAI_API_KEY
             openai.organization = OPENAI_ORGANIZATION
+            setattr(app.state, routes.CONFIG_OPENAI_TOKEN_MANAGER, None)
 
         setattr(app.state, routes.CONFIG_CREDENTIAL, azure_credential)
-        setattr(app.state, routes.CONFIG_SEARCH_CLIENT, search_client)
-        setattr(app.state, routes.CONFIG_BLOB_CONTAINER_CLIENT, blob_container_client)
         setattr(app.state, routes.CONFIG_AUTH_CLIENT, auth_helper)
+        setattr(app.state, routes.CONFIG_AUTH_SETUP_BODY, orjson.dumps(auth_helper.get_auth_setup_for_client()))
 
         # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
         # or some derivative, here we include several for exploration purposes
 
-        setattr(app.state, routes.CONFIG_ASK_APPROACH, RetrieveThenReadApproach(
-            search_client,
-            OPENAI_HOST,
-            AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-            OPENAI_CHATGPT_MODEL,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
-            OPENAI_EMB_MODEL,
-            KB_FIELDS_SOURCEPAGE,
-            KB_FIELDS_CONTENT,
-            AZURE_SEARCH_QUERY_LANGUAGE,
-            AZURE_SEARCH_QUERY_SPELLER,
-        ))
-
-        setattr(app.state, routes.CONFIG_CHAT_APPROACH, ChatReadRetrieveReadApproach(
-            search_client,
-            OPENAI_HOST,
-            AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-            OPENAI_CHATGPT_MODEL,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
-            OPENAI_EMB_MODEL,
-            KB_FIELDS_SOURCEPAGE,
-            KB_FIELDS_CONTENT,
-            AZURE_SEARCH_QUERY_LANGUAGE,
-            AZURE_SEARCH_QUERY_SPELLER,
-        ))
-    app.add_event_handler("startup", setup_clients)
+        async def create_ask_approach():
+            return RetrieveThenReadApproach(
+                await routes.get_search_client(app),
+                OPENAI_HOST,
+                AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+                OPENAI_CHATGPT_MODEL,
+                AZURE_OPENAI_EMB_DEPLOYMENT,
+                OPENAI_EMB_MODEL,
+                KB_FIELDS_SOURCEPAGE,
+                KB_FIELDS_CONTENT,
+                AZURE_SEARCH_QUERY_LANGUAGE,
+                AZURE_SEARCH_QUERY_SPELLER,
+            )
 
-    async def ensure_openai_token(request: Request, call_next):
-        if openai.api_type != "azure_ad":
-            return await call_next(request)
-        openai_token = getattr(app.state, routes.CONFIG_OPENAI_TOKEN)
-        if openai_token.expires_on < time.time() + 60:
-            openai_token = await getattr(app.state, routes.CONFIG_CREDENTIAL).get_token(
-                "https://cognitiveservices.azure.com/.default"
+        async def create_chat_approach():
+            return ChatReadRetrieveReadApproach(
+                await routes.get_search_client(app),
+                OPENAI_HOST,
+                AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+                OPENAI_CHATGPT_MODEL,
+                AZURE_OPENAI_EMB_DEPLOYMENT,
+                OPENAI_EMB_MODEL,
+                KB_FIELDS_SOURCEPAGE,
+                KB_FIELDS_CONTENT,
+                AZURE_SEARCH_QUERY_LANGUAGE,
+                AZURE_SEARCH_QUERY_SPELLER,
             )
-            setattr(app.state, routes.CONFIG_OPENAI_TOKEN, openai_token)
-            openai.api_key = openai_token.token
-        return await call_next(request)
 
-    app.middleware("http")(ensure_openai_token)
+        routes.register_state_client(app, routes.CONFIG_SEARCH_CLIENT, create_search_client)
+        routes.register_state_client(app, routes.CONFIG_BLOB_CONTAINER_CLIENT, create_blob_container_client)
+        routes.register_state_client(app, routes.CONFIG_ASK_APPROACH, create_ask_approach)
+        routes.register_state_client(app, routes.CONFIG_CHAT_APPROACH, create_chat_approach)
+
+    app.add_event_handler("startup", setup_clients)
+
+    async def close_clients():
+        openai_token_manager = getattr(app.state, routes.CONFIG_OPENAI_TOKEN_MANAGER, None)
+        if openai_token_manager:
+            await openai_token_manager.close()
+        openai_session = getattr(app.state, routes.CONFIG_OPENAI_SESSION, None)
+        if openai_session:
+            await openai_session.close()
+        search_client = getattr(app.state, routes.CONFIG_SEARCH_CLIENT, None)
+        if search_client:
+            await search_client.close()
+        blob_container_client = getattr(app.state, routes.CONFIG_BLOB_CONTAINER_CLIENT, None)
+        if blob_container_client:
+            await blob_container_client.close()
+        # The transports don't own the session, so it has to be closed separately
+        azure_session = getattr(app.state, routes.CONFIG_AZURE_SESSION, None)
+        if azure_session:
+            await azure_session.close()
+
+    app.add_event_handler("shutdown", close_clients)
+    # Registered after close_clients, since shutdown handlers run in order and closing clients can still log
+    if log_listener:
+        app.add_event_handler("shutdown", log_listener.stop)
 
     app.include_router(routes.router)
-    app.mount("/static", StaticFiles(directory="static"), name="static")
-    # app.mount("/favicon.ico", StaticFiles(directory="static"), name="favicon")
-    # app.mount("/assets", StaticFiles(directory="static/assets"), name="assets")
+    app.add_exception_handler(routes.StateClientError, routes.handle_state_client_error)
+    app.mount("/assets", StaticFiles(directory=routes.STATIC_DIR / "assets"), name="assets")
+    app.mount("/static", StaticFiles(directory=routes.STATIC_DIR), name="static")
     return app
 
@@ -3,7 +3,6 @@ import logging
 import re
 from typing import Any, AsyncGenerator, Optional, Union
 
-import aiohttp
 import openai
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
@@ -315,10 +314,7 @@ If you cannot generate a search query, return just the number 0.
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
         if stream is False:
-            # Workaround for: https://github.com/openai/openai-python/issues/371
-            async with aiohttp.ClientSession() as s:
-                openai.aiosession.set(s)
-                response = await self.run_without_streaming(messages, overrides, auth_claims, session_state)
+            response = await self.run_without_streaming(messages, overrides, auth_claims, session_state)
             return response
         else:
             return self.run_with_streaming(messages, overrides, auth_claims, session_state)
@@ -8,6 +8,9 @@ bind = "0.0.0.0"
 timeout = 230
 # https://learn.microsoft.com/en-us/troubleshoot/azure/app-service/web-apps-performance-faqs#why-does-my-request-time-out-after-230-seconds
 
+# Requests spend nearly all their time waiting on Azure OpenAI, AI Search and Blob Storage,
+# so a couple of workers per CPU is enough to keep the CPUs busy
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
+# UvicornWorker picks uvloop and httptools automatically when they are installed (see requirements.in)
 worker_class = "uvicorn.workers.UvicornWorker"
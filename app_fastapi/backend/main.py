@@ -1,4 +1,3 @@
 from app_fastapi import create_app
 
-
 app = create_app()
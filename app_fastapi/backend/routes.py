@@ -1,85 +1,223 @@
-import fastapi
-import openai
-import io
+import asyncio
 import logging
 import mimetypes
+import urllib.parse
 from pathlib import Path
-from typing import AsyncGenerator
-from fastapi.responses import JSONResponse
-from fastapi.responses import FileResponse
-import aiohttp
-import json
-from azure.core.exceptions import ResourceNotFoundError
+from typing import Any, AsyncGenerator, Awaitable, Callable
+
+import fastapi
+import openai
+import orjson
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.search.documents.aio import SearchClient
+from azure.storage.blob.aio import ContainerClient
+from fastapi import (
+    Body,
+    Depends,
+    File,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+)
+from fastapi.responses import FileResponse, ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
+from starlette.background import BackgroundTask
 from starlette.responses import StreamingResponse
-from fastapi import Request, HTTPException, Query, UploadFile, File, Body
-from pydantic import BaseModel, Field
 
+from approaches.approach import Approach
+from core.authentication import AuthenticationHelper
 
-CONFIG_OPENAI_TOKEN = "openai_token"
+CONFIG_OPENAI_TOKEN_MANAGER = "openai_token_manager"
+CONFIG_OPENAI_SESSION = "openai_session"
+CONFIG_AZURE_SESSION = "azure_session"
 CONFIG_CREDENTIAL = "azure_credential"
 CONFIG_ASK_APPROACH = "ask_approach"
 CONFIG_CHAT_APPROACH = "chat_approach"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
 CONFIG_AUTH_CLIENT = "auth_client"
+CONFIG_AUTH_SETUP_BODY = "auth_setup_body"
 CONFIG_SEARCH_CLIENT = "search_client"
+CONFIG_CLIENT_FACTORIES = "client_factories"
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
 """
 ERROR_MESSAGE_FILTER = """Your message contains content that was flagged by the OpenAI content filter."""
+# Pre-encoded body for the content filter error, which doesn't depend on the error details
+ERROR_BODY_FILTER = orjson.dumps({"error": ERROR_MESSAGE_FILTER})
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+# Cache lifetimes for GET responses that don't change while the app is running.
+# index.html is left uncached so clients pick up new frontend builds right away.
+CACHE_CONTROL_STATIC = "public, max-age=3600"
+CACHE_CONTROL_CONTENT = "max-age=300"
+# Upper bound on how much streamed /chat output is held back before it is sent
+NDJSON_FLUSH_BYTES = 4096
 
 
 router = fastapi.APIRouter()
 
 
+def register_state_client(app: fastapi.FastAPI, key: str, factory: Callable[[], Awaitable[Any]]):
+    factories = getattr(app.state, CONFIG_CLIENT_FACTORIES, None)
+    if factories is None:
+        factories = {}
+        setattr(app.state, CONFIG_CLIENT_FACTORIES, factories)
+    factories[key] = (factory, asyncio.Lock())
+
+
+# Return the client stored on app.state under key, creating it with its registered factory on first use
+async def get_state_client(app: fastapi.FastAPI, key: str) -> Any:
+    client = getattr(app.state, key, None)
+    if client is None:
+        factory, lock = getattr(app.state, CONFIG_CLIENT_FACTORIES)[key]
+        async with lock:
+            # Another request may have created the client while we were waiting for the lock
+            client = getattr(app.state, key, None)
+            if client is None:
+                client = await factory()
+                setattr(app.state, key, client)
+    return client
+
+
+async def get_search_client(app: fastapi.FastAPI) -> SearchClient:
+    return await get_state_client(app, CONFIG_SEARCH_CLIENT)
+
+
+# StateClientError is raised by the dependency providers below when a client fails to initialize.
+# Dependencies are resolved outside the handlers' try blocks, so create_app registers
+# handle_state_client_error to turn it into the same JSON error response the handlers send
+class StateClientError(Exception):
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+async def handle_state_client_error(request: Request, exc: StateClientError) -> Response:
+    return error_response(exc.error, request.url.path)
+
+
+async def get_state_dependency(request: Request, key: str) -> Any:
+    try:
+        return await get_state_client(request.app, key)
+    except Exception as error:
+        raise StateClientError(error) from error
+
+
+# Dependencies for the route handlers, resolved by FastAPI once per request.
+# They are all async: FastAPI runs sync dependencies in the threadpool
+
+
+async def get_auth_helper(request: Request) -> AuthenticationHelper:
+    return getattr(request.app.state, CONFIG_AUTH_CLIENT)
+
+
+async def get_blob_container_client(request: Request) -> ContainerClient:
+    return await get_state_dependency(request, CONFIG_BLOB_CONTAINER_CLIENT)
+
+
+async def get_ask_approach(request: Request) -> Approach:
+    return await get_state_dependency(request, CONFIG_ASK_APPROACH)
+
+
+async def get_chat_approach(request: Request) -> Approach:
+    return await get_state_dependency(request, CONFIG_CHAT_APPROACH)
+
+
 # @router.post("/ask")
 @router.get("/")
 async def index():
-    return FileResponse('static/index.html')
+    return FileResponse(STATIC_DIR / "index.html")
 
 
 # Empty page is recommended for login redirect to work.
 # See https://github.com/AzureAD/microsoft-authentication-library-for-js/blob/dev/lib/msal-browser/docs/initialization.md#redirecturi-considerations for more information
 @router.get("/redirect")
-async def redirect():
+async def redirect(response: Response):
+    response.headers["Cache-Control"] = CACHE_CONTROL_STATIC
     return ""
 
 
 @router.get("/favicon.ico")
 async def favicon():
-    return FileResponse(str(Path(__file__).parent / "static" / "favicon.ico"))
+    return FileResponse(STATIC_DIR / "favicon.ico", headers={"Cache-Control": CACHE_CONTROL_STATIC})
 
 
-@router.get("/assets/{path:path}")
-async def assets(path: str):
-    return FileResponse(str(Path(__file__).parent / "static" / "assets" / path))
+# /assets is served by a StaticFiles mount, see create_app
 
 
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files.
 @router.get("/content/{path}")
-async def content_file(request: Request, path: str):
-    if path.find("#page=") > 0:
-        path_parts = path.rsplit("#page=", 1)
-        path = path_parts[0]
-    logging.info("Opening file %s at page %s", path)
-    blob_container_client = getattr(request.app.state, CONFIG_BLOB_CONTAINER_CLIENT)
+async def content_file(
+    request: Request, path: str, blob_container_client: ContainerClient = Depends(get_blob_container_client)
+):
+    # Remove page number from path, filename.pdf#page=1 -> filename.pdf
+    path, _, page = path.partition("#page=")
+    logging.info("Opening file %s at page %s", path, page)
+    # Let Blob Storage evaluate the client's cached ETag, so unchanged files aren't downloaded again
+    conditions = {}
+    if if_none_match := request.headers.get("if-none-match"):
+        conditions = {"etag": if_none_match, "match_condition": MatchConditions.IfModified}
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
+        # get_blob_client reuses the container client's pipeline (policies, cached token and transport),
+        # which is cheaper than building a standalone BlobClient from a URL and credential per request
+        downloader = await blob_container_client.get_blob_client(path).download_blob(**conditions)
     except ResourceNotFoundError:
         logging.exception("Path not found: %s", path)
         raise HTTPException(status_code=404)
-    if not blob.properties or not blob.properties.has_key("content_settings"):
+    except HttpResponseError as error:
+        # The storage SDK reports a 304 as a plain HttpResponseError (or ResourceModifiedError), never
+        # as ResourceNotModifiedError, so it has to be recognized by its status code
+        if error.status_code != 304:
+            raise
+        headers = {"Cache-Control": CACHE_CONTROL_CONTENT}
+        # If-None-Match may be "*", weak or a list, so send the blob's own ETag back rather than echoing it
+        if error.response and (etag := error.response.headers.get("ETag")):
+            headers["ETag"] = etag
+        return Response(status_code=304, headers=headers)
+    if not downloader.properties or not downloader.properties.has_key("content_settings"):
         raise HTTPException(status_code=404)
-    mime_type = blob.properties["content_settings"]["content_type"]
+    mime_type = downloader.properties["content_settings"]["content_type"]
     if mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return FileResponse(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+
+    # Stream the blob chunk by chunk instead of buffering the whole file in memory
+    async def iter_chunks():
+        async for chunk in downloader.chunks():
+            yield chunk
+
+    # Header values are latin-1, so non-ASCII names (e.g. Chinese) are sent RFC 5987-encoded, like FileResponse does
+    quoted_path = urllib.parse.quote(path)
+    if quoted_path != path:
+        content_disposition = f"inline; filename*=utf-8''{quoted_path}"
+    else:
+        content_disposition = f'inline; filename="{path}"'
+
+    return StreamingResponse(
+        iter_chunks(),
+        media_type=mime_type,
+        headers={
+            "Content-Length": str(downloader.size),
+            "Content-Disposition": content_disposition,
+            "ETag": downloader.properties.etag,
+            "Cache-Control": CACHE_CONTROL_CONTENT,
+        },
+    )
+
+
+# Request bodies for /ask and /chat, validated by FastAPI before the handler runs
+class AskRequest(BaseModel):
+    messages: list[dict]
+    context: dict[str, Any] = {}
+    session_state: Any = None
+
+
+class ChatRequest(AskRequest):
+    stream: bool = False
 
 
 def error_dict(error: Exception) -> dict:
@@ -88,75 +226,101 @@ def error_dict(error: Exception) -> dict:
     return {"error": ERROR_MESSAGE.format(error_type=type(error))}
 
 
-def error_response(error: Exception, route: str, status_code: int = 500):
-    logging.exception("Exception in %s: %s", route, error)
+def error_response(error: Exception, route: str, status_code: int = 500) -> Response:
+    # Log after the response has been sent, so formatting the traceback doesn't delay it
+    log_task = BackgroundTask(logging.error, "Exception in %s: %s", route, error, exc_info=error)
     if isinstance(error, openai.error.InvalidRequestError) and error.code == "content_filter":
-        status_code = 400
-    return JSONResponse(error_dict(error)), status_code
+        return Response(content=ERROR_BODY_FILTER, media_type="application/json", status_code=400, background=log_task)
+    return ORJSONResponse(error_dict(error), status_code=status_code, background=log_task)
 
 
-@router.post("/ask")
-async def ask(request: Request):
-    # return JSONResponse("hi")
-    try:
-        request_json = await request.json()
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=415, detail="request must be json")
-   
-    context = request_json.get("context", {})
-    auth_helper = getattr(request.app.state, CONFIG_AUTH_CLIENT)
+async def ensure_openai_token(request: Request):
+    # The token is normally kept fresh by the manager's background task, this only waits
+    # when the cached token is about to expire (e.g. after a failed background refresh)
+    openai_token_manager = getattr(request.app.state, CONFIG_OPENAI_TOKEN_MANAGER)
+    if openai_token_manager:
+        await openai_token_manager.get_token()
+
+
+def set_openai_session(request: Request):
+    # openai.aiosession is a context variable, so it has to be set in the request's own context.
+    # Otherwise the SDK opens (and tears down) a new aiohttp session for every call.
+    # See: https://github.com/openai/openai-python/issues/371
+    openai.aiosession.set(getattr(request.app.state, CONFIG_OPENAI_SESSION))
+
 
+@router.post("/ask")
+async def ask(
+    ask_request: AskRequest,
+    request: Request,
+    auth_helper: AuthenticationHelper = Depends(get_auth_helper),
+    approach: Approach = Depends(get_ask_approach),
+):
+    context = ask_request.context
     context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
     try:
-        approach = getattr(request.app.state, CONFIG_ASK_APPROACH)
-        # Workaround for: https://github.com/openai/openai-python/issues/371
-        async with aiohttp.ClientSession() as s:
-            openai.aiosession.set(s)
-            r = await approach.run(
-                request_json["messages"], context=context, session_state=request_json.get("session_state")
-            )
-        return JSONResponse(r)
+        await ensure_openai_token(request)
+        set_openai_session(request)
+        r = await approach.run(ask_request.messages, context=context, session_state=ask_request.session_state)
+        return ORJSONResponse(r)
     except Exception as error:
         return error_response(error, "/ask")
 
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[bytes, None]:
     try:
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False) + "\n"
+            yield orjson.dumps(event) + b"\n"
     except Exception as e:
         logging.exception("Exception while generating response stream: %s", e)
-        yield json.dumps(error_dict(e))
+        yield orjson.dumps(error_dict(e))
 
 
-@router.post("/chat")
-async def chat(request: Request):
-    try:
-        request_json = await request.json()
-    except json.JSONDecodeError:
-        return JSONResponse({"error": "request must be json"}, status_code=415)
+def is_visible_chunk(item: dict) -> bool:
+    for choice in item.get("choices", []):
+        if choice.get("delta", {}).get("content") or choice.get("context") or choice.get("finish_reason"):
+            return True
+    return False
 
-    context = request_json.get("context", {})
-    auth_helper = getattr(request.app.state, CONFIG_AUTH_CLIENT)
 
+@router.post("/chat")
+async def chat(
+    chat_request: ChatRequest,
+    request: Request,
+    auth_helper: AuthenticationHelper = Depends(get_auth_helper),
+    approach: Approach = Depends(get_chat_approach),
+):
+    context = chat_request.context
     context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
     try:
-        approach = getattr(request.app.state, CONFIG_CHAT_APPROACH)
+        await ensure_openai_token(request)
+        set_openai_session(request)
         result = await approach.run(
-            request_json["messages"],
-            stream=request_json.get("stream", False),
+            chat_request.messages,
+            stream=chat_request.stream,
             context=context,
-            session_state=request_json.get("session_state"),
+            session_state=chat_request.session_state,
         )
         if isinstance(result, dict):
-            return JSONResponse(result)
+            return ORJSONResponse(result)
         # if isinstance(result, AsyncGenerator):
         else:
             async def generate():
+                # Coalesce items that carry nothing to display (e.g. role-only deltas) with the next one,
+                # so they don't each cost a separate send, but never hold back visible output
+                buffer = bytearray()
                 async for item in result:
-                    yield json.dumps(item).encode('utf-8') + b'\n' # Add newline after each JSON item
-            # Return as streaming response
-            return StreamingResponse(generate(), media_type="application/x-ndjson")
+                    buffer += orjson.dumps(item)
+                    buffer += b"\n"  # Add newline after each JSON item
+                    if len(buffer) >= NDJSON_FLUSH_BYTES or is_visible_chunk(item):
+                        yield bytes(buffer)
+                        buffer.clear()
+                if buffer:
+                    yield bytes(buffer)
+            # Return as streaming response, telling reverse proxies (nginx) not to buffer it
+            return StreamingResponse(
+                generate(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"}
+            )
         # else:
         #     response = Response(content=format_as_ndjson(result))
         #     response.headers["Content-Type"] = "application/json-lines"
@@ -167,10 +331,13 @@ async def chat(request: Request):
 
 # Send MSAL.js settings to the client UI
 @router.get("/auth_setup")
-def auth_setup(request: Request):
-    # return JSONResponse("hi")
-    auth_helper = getattr(request.app.state, CONFIG_AUTH_CLIENT)
-    return JSONResponse(auth_helper.get_auth_setup_for_client())
+async def auth_setup(request: Request):
+    # The settings don't change while the app is running, so the body is encoded once in setup_clients
+    return Response(
+        content=getattr(request.app.state, CONFIG_AUTH_SETUP_BODY),
+        media_type="application/json",
+        headers={"Cache-Control": CACHE_CONTROL_STATIC},
+    )
 
 
 @router.post("/file/upload", tags=["Storage"], summary="文件上传")
@@ -189,7 +356,14 @@ def list_file(file_ids: list[str] = Query(...)):
 
 ##########################################    Agent    ##########################################
 
+class ResultModel(BaseModel):
+    code: int = Field(0, title="code", description="状态码")
+    message: str = Field(..., title="message", description="提示信息")
+
+
 class GenerateContextResultModel(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     topic_description: str = Field(..., title="topic_description", description="主题描述")
     audience_description: str = Field(..., title="audience_description", description="观众描述")
     is_horizental: bool = Field(..., title="is_horizental", description="横竖屏")
@@ -200,7 +374,26 @@ class GenerateContextResultModel(BaseModel):
     title_array: list[str] = Field(..., title="title_array", description="标题数组")
 
 
-@router.post("/agent/generate_context", tags=["Agent"], summary="生成上下文参数")
+# Request body of /agent/generate_explain. extra="forbid" only guards the context the server builds itself,
+# clients may send keys it doesn't know about (they are ignored)
+class GenerateExplainRequestModel(GenerateContextResultModel):
+    model_config = ConfigDict(extra="ignore")
+
+
+class GenerateContextResponseModel(ResultModel):
+    context: GenerateContextResultModel = Field(..., title="context", description="上下文参数")
+
+
+class GenerateExplainResponseModel(ResultModel):
+    data: list[str] = Field(..., title="data", description="讲解或问答回复")
+
+
+@router.post(
+    "/agent/generate_context",
+    tags=["Agent"],
+    summary="生成上下文参数",
+    response_model=GenerateContextResponseModel,
+)
 def generate_context(assistant_id: str = Query(...), template_id: str = Query(..., description="参数内容对应的模板")):
     contextData = GenerateContextResultModel(
         topic_description="custom_topic_description",
@@ -212,11 +405,16 @@ def generate_context(assistant_id: str = Query(...), template_id: str = Query(..
         quantity=3,
         title_array=["custom_title1","custom_title2","custom_title3"]
     )
-    return {"code": 0, "message": "生成成功", "context": contextData}
-
-@router.post("/agent/generate_explain", tags=["Agent"], summary="生成讲解文案/互动问答")
-def generate_explain(assistant_id: str = Query(...), context: GenerateContextResultModel=Body(...)):
-    return {"code": 0, "message": "生成成功", "data": ["讲解或问答回复"]}
+    return GenerateContextResponseModel(message="生成成功", context=contextData)
+
+@router.post(
+    "/agent/generate_explain",
+    tags=["Agent"],
+    summary="生成讲解文案/互动问答",
+    response_model=GenerateExplainResponseModel,
+)
+def generate_explain(assistant_id: str = Query(...), context: GenerateExplainRequestModel=Body(...)):
+    return GenerateExplainResponseModel(message="生成成功", data=["讲解或问答回复"])
 
 
 
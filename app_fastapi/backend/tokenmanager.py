@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from azure.core.credentials_async import AsyncTokenCredential
+
+
+@dataclass
+class CachedToken:
+    token: str
+    expires_on: int
+
+
+# TokenManager caches the access token for a single scope and refreshes it in the background
+# shortly before it expires, so request handlers only ever read the cached value
+class TokenManager:
+    # Minimum remaining lifetime for a cached token to be handed out to a request
+    min_validity: int = 60
+    # How long before expiry the background task refreshes the token
+    refresh_margin: int = 300
+    # How long the background task waits before retrying a failed refresh
+    retry_delay: int = 30
+
+    def __init__(
+        self,
+        credential: AsyncTokenCredential,
+        scope: str,
+        on_refresh: Optional[Callable[[str], None]] = None,
+    ):
+        self.credential = credential
+        self.scope = scope
+        self.on_refresh = on_refresh
+        self.cached_token: Optional[CachedToken] = None
+        self.refresh_future: Optional[asyncio.Future] = None
+        self.refresh_task: Optional[asyncio.Task] = None
+
+    def is_valid(self, margin: int) -> bool:
+        return self.cached_token is not None and self.cached_token.expires_on > time.time() + margin
+
+    async def get_token(self) -> str:
+        if not self.is_valid(self.min_validity):
+            await self.refresh_once()
+            self.start_auto_refresh()
+        assert self.cached_token is not None
+        return self.cached_token.token
+
+    # Concurrent callers share a single in-flight refresh and its outcome, so a burst of requests
+    # around expiry (or during an outage of the token endpoint) results in one call, not one per request
+    async def refresh_once(self):
+        if self.refresh_future is None:
+            self.refresh_future = asyncio.ensure_future(self.refresh())
+            self.refresh_future.add_done_callback(self.clear_refresh_future)
+        # Shielded so that a cancelled request doesn't cancel the refresh the others are waiting for
+        await asyncio.shield(self.refresh_future)
+
+    def clear_refresh_future(self, future: asyncio.Future):
+        self.refresh_future = None
+
+    async def refresh(self):
+        access_token = await self.credential.get_token(self.scope)
+        self.cached_token = CachedToken(token=access_token.token, expires_on=access_token.expires_on)
+        if self.on_refresh:
+            self.on_refresh(access_token.token)
+
+    def start_auto_refresh(self):
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self.auto_refresh())
+
+    async def auto_refresh(self):
+        # Fetches the first token right away, then refreshes it shortly before each expiry
+        while True:
+            delay = 0.0
+            if self.cached_token is not None:
+                delay = max(self.cached_token.expires_on - self.refresh_margin - time.time(), self.retry_delay)
+            await asyncio.sleep(delay)
+            try:
+                if not self.is_valid(self.refresh_margin):
+                    await self.refresh_once()
+            except Exception:
+                logging.exception("Failed to refresh token for %s", self.scope)
+                await asyncio.sleep(self.retry_delay)
+
+    async def close(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            try:
+                await self.refresh_task
+            except asyncio.CancelledError:
+                pass
+            self.refresh_task = None
@@ -15,6 +15,8 @@ from azure.core.credentials_async import AsyncTokenCredential
 from azure.search.documents.aio import SearchClient
 
 import app
+import app_fastapi
+import routes
 from core.authentication import AuthenticationHelper
 
 MockToken = namedtuple("MockToken", ["token", "expires_on"])
@@ -203,6 +205,15 @@ def mock_env(monkeypatch, request):
             yield
 
 
+@pytest.fixture
+def fastapi_app(monkeypatch, tmp_path):
+    # The StaticFiles mounts require the built frontend, which the tests don't need
+    (tmp_path / "assets").mkdir()
+    monkeypatch.setattr(routes, "STATIC_DIR", tmp_path)
+    # Startup handlers don't run, so tests put the clients they need on app.state themselves
+    return app_fastapi.create_app()
+
+
 @pytest_asyncio.fixture()
 async def client(monkeypatch, mock_env, mock_openai_chatcompletion, mock_openai_embedding, mock_acs_search, request):
     quart_app = app.create_app()
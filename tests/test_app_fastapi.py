@@ -0,0 +1,97 @@
+from unittest import mock
+
+import openai
+import pytest
+from fastapi.testclient import TestClient
+
+import routes
+from core.authentication import AuthenticationHelper
+
+
+class MockApproach:
+    def __init__(self, error):
+        self.run = mock.AsyncMock(side_effect=error)
+
+
+@pytest.fixture
+def fastapi_client(fastapi_app):
+    auth_helper = AuthenticationHelper(
+        use_authentication=False, server_app_id=None, server_app_secret=None, client_app_id=None, tenant_id=None
+    )
+    setattr(fastapi_app.state, routes.CONFIG_AUTH_CLIENT, auth_helper)
+    setattr(fastapi_app.state, routes.CONFIG_OPENAI_TOKEN_MANAGER, None)
+    setattr(fastapi_app.state, routes.CONFIG_OPENAI_SESSION, None)
+    return TestClient(fastapi_app)
+
+
+def test_routes_registered_once(fastapi_app):
+    assert len({r.path for r in fastapi_app.routes}) == len(fastapi_app.routes)
+
+
+@pytest.mark.parametrize(
+    "route, config_key", [("/ask", routes.CONFIG_ASK_APPROACH), ("/chat", routes.CONFIG_CHAT_APPROACH)]
+)
+def test_handle_exception(fastapi_app, fastapi_client, caplog, route, config_key):
+    setattr(fastapi_app.state, config_key, MockApproach(ZeroDivisionError("something bad happened")))
+
+    response = fastapi_client.post(
+        route,
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 500
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json() == {"error": routes.ERROR_MESSAGE.format(error_type=ZeroDivisionError)}
+    assert f"Exception in {route}: something bad happened" in caplog.text
+
+
+@pytest.mark.parametrize(
+    "route, config_key", [("/ask", routes.CONFIG_ASK_APPROACH), ("/chat", routes.CONFIG_CHAT_APPROACH)]
+)
+def test_handle_exception_contentsafety(fastapi_app, fastapi_client, caplog, route, config_key):
+    error = openai.error.InvalidRequestError("The response was filtered", "prompt", code="content_filter")
+    setattr(fastapi_app.state, config_key, MockApproach(error))
+
+    response = fastapi_client.post(
+        route,
+        json={"messages": [{"content": "How do I do something bad?", "role": "user"}]},
+    )
+    assert response.status_code == 400
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.content == routes.ERROR_BODY_FILTER
+    assert f"Exception in {route}: The response was filtered" in caplog.text
+
+
+def test_handle_client_factory_exception(fastapi_app, fastapi_client, caplog):
+    async def create_failing_approach():
+        raise ZeroDivisionError("something bad happened")
+
+    routes.register_state_client(fastapi_app, routes.CONFIG_ASK_APPROACH, create_failing_approach)
+
+    response = fastapi_client.post(
+        "/ask",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    # The factory fails while FastAPI resolves the dependency, before the handler's own try block
+    assert response.status_code == 500
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json() == {"error": routes.ERROR_MESSAGE.format(error_type=ZeroDivisionError)}
+    assert "Exception in /ask: something bad happened" in caplog.text
+    # A failed factory doesn't leave a client behind, so the next request tries again
+    assert getattr(fastapi_app.state, routes.CONFIG_ASK_APPROACH, None) is None
+
+
+def test_generate_explain_ignores_extra_context_keys(fastapi_client):
+    context = {
+        "topic_description": "topic",
+        "audience_description": "audience",
+        "is_horizental": False,
+        "language": "en",
+        "style": "style",
+        "duration": 1.5,
+        "quantity": 3,
+        "title_array": ["title1"],
+        "unknown_key": "value",
+    }
+    response = fastapi_client.post("/agent/generate_explain", params={"assistant_id": "id"}, json=context)
+    assert response.status_code == 200
+    assert response.json()["data"] == ["讲解或问答回复"]
@@ -0,0 +1,157 @@
+import os
+from collections import namedtuple
+
+import aiohttp
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import (
+    AioHttpTransportResponse,
+    AsyncHttpTransport,
+    HttpRequest,
+)
+from azure.storage.blob.aio import BlobServiceClient
+from fastapi.testclient import TestClient
+
+import routes
+
+MockToken = namedtuple("MockToken", ["token", "expires_on"])
+
+MOCK_ETAG = '"0x8DBD1A2B3C4D5E6"'
+MOCK_CONTENT = b"test content"
+
+
+class MockAzureCredential:
+    async def get_token(self, uri):
+        return MockToken("mock_token", 9999999999)
+
+
+class MockAiohttpClientResponse(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, headers=None, status=200, reason="OK"):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = status
+        self.reason = reason
+        self._url = url
+
+
+class MockTransport(AsyncHttpTransport):
+    def __init__(self, content_type="application/octet-stream", not_modified_headers=None):
+        self.content_type = content_type
+        self.not_modified_headers = {"ETag": MOCK_ETAG, **(not_modified_headers or {})}
+
+    async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+        if request.url.endswith("notfound.pdf"):
+            raise ResourceNotFoundError(MockAiohttpClientResponse(request.url, b"", status=404, reason="Not Found"))
+        if request.headers.get("If-None-Match") == MOCK_ETAG:
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(
+                    request.url, b"", self.not_modified_headers, status=304, reason="Not Modified"
+                ),
+            )
+        # Serve the requested range, so downloads split into several chunks behave like the real service
+        start, end = 0, len(MOCK_CONTENT) - 1
+        if range_header := request.headers.get("x-ms-range"):
+            first, last = range_header.split("=")[1].split("-")
+            start, end = int(first), min(int(last), end)
+        return AioHttpTransportResponse(
+            request,
+            MockAiohttpClientResponse(
+                request.url,
+                MOCK_CONTENT[start : end + 1],
+                {
+                    "Content-Type": self.content_type,
+                    "Content-Range": f"bytes {start}-{end}/{len(MOCK_CONTENT)}",
+                    "Content-Length": str(end + 1 - start),
+                    "ETag": MOCK_ETAG,
+                },
+                status=206 if range_header else 200,
+            ),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def create_test_client(fastapi_app, transport, **kwargs):
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=transport,
+        retry_total=0,  # Necessary to avoid unnecessary network requests during tests
+        **kwargs,
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+    setattr(fastapi_app.state, routes.CONFIG_BLOB_CONTAINER_CLIENT, blob_container_client)
+    return TestClient(fastapi_app)
+
+
+def test_content_file(fastapi_app, mock_env):
+    client = create_test_client(fastapi_app, MockTransport())
+
+    response = client.get("/content/notfound.pdf")
+    assert response.status_code == 404
+
+    response = client.get("/content/role_library.pdf")
+    assert response.status_code == 200
+    # application/octet-stream blobs fall back to the type guessed from the name
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert response.headers["Content-Length"] == str(len(MOCK_CONTENT))
+    assert response.headers["ETag"] == MOCK_ETAG
+    assert response.headers["Content-Disposition"] == 'inline; filename="role_library.pdf"'
+    assert response.content == MOCK_CONTENT
+
+    response = client.get("/content/role_library.pdf#page=10")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert response.content == MOCK_CONTENT
+
+
+def test_content_file_streams_chunks(fastapi_app, mock_env):
+    # Small download sizes make the SDK fetch the blob in several ranged requests
+    client = create_test_client(fastapi_app, MockTransport(), max_single_get_size=4, max_chunk_get_size=4)
+
+    response = client.get("/content/role_library.pdf")
+    assert response.status_code == 200
+    assert response.headers["Content-Length"] == str(len(MOCK_CONTENT))
+    assert response.content == MOCK_CONTENT
+
+
+def test_content_file_keeps_blob_content_type(fastapi_app, mock_env):
+    client = create_test_client(fastapi_app, MockTransport(content_type="text/plain"))
+
+    response = client.get("/content/role_library.pdf")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+
+
+def test_content_file_non_ascii_name(fastapi_app, mock_env):
+    client = create_test_client(fastapi_app, MockTransport())
+
+    response = client.get("/content/角色库.pdf")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert response.headers["Content-Disposition"] == "inline; filename*=utf-8''%E8%A7%92%E8%89%B2%E5%BA%93.pdf"
+    assert response.content == MOCK_CONTENT
+
+
+# Depending on the error code header, the storage SDK raises the 304 as HttpResponseError or ResourceModifiedError
+@pytest.mark.parametrize("not_modified_headers", [{}, {"x-ms-error-code": "ConditionNotMet"}])
+def test_content_file_not_modified(fastapi_app, mock_env, not_modified_headers):
+    client = create_test_client(fastapi_app, MockTransport(not_modified_headers=not_modified_headers))
+
+    response = client.get("/content/role_library.pdf", headers={"If-None-Match": MOCK_ETAG})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == MOCK_ETAG
+    assert response.headers["Cache-Control"] == routes.CACHE_CONTROL_CONTENT
+    assert response.content == b""
@@ -0,0 +1,162 @@
+import asyncio
+import time
+from collections import namedtuple
+
+import pytest
+from azure.core.credentials_async import AsyncTokenCredential
+
+from tokenmanager import TokenManager
+
+MockToken = namedtuple("MockToken", ["token", "expires_on"])
+
+
+class MockAzureCredential(AsyncTokenCredential):
+    def __init__(self, lifetime=3600, fail_times=0):
+        self.calls = 0
+        self.lifetime = lifetime
+        self.fail_times = fail_times
+        # Cleared to hold get_token calls in flight until the test releases them
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        await self.release.wait()
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise Exception("token endpoint unavailable")
+        return MockToken(f"mock_token_{self.calls}", int(time.time()) + self.lifetime)
+
+
+@pytest.mark.asyncio
+async def test_get_token_coalesces_concurrent_callers():
+    credential = MockAzureCredential()
+    credential.release.clear()
+    manager = TokenManager(credential, "scope")
+    waiters = [asyncio.create_task(manager.get_token()) for _ in range(10)]
+    await asyncio.sleep(0)
+    credential.release.set()
+    tokens = await asyncio.gather(*waiters)
+    assert credential.calls == 1
+    assert tokens == ["mock_token_1"] * 10
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_get_token_uses_cached_token():
+    credential = MockAzureCredential()
+    manager = TokenManager(credential, "scope")
+    assert await manager.get_token() == "mock_token_1"
+    assert await manager.get_token() == "mock_token_1"
+    assert credential.calls == 1
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_get_token_shares_error_and_clears_future():
+    credential = MockAzureCredential(fail_times=1)
+    credential.release.clear()
+    manager = TokenManager(credential, "scope")
+    waiters = [asyncio.create_task(manager.get_token()) for _ in range(5)]
+    await asyncio.sleep(0)
+    credential.release.set()
+    results = await asyncio.gather(*waiters, return_exceptions=True)
+    assert credential.calls == 1
+    assert all(isinstance(result, Exception) for result in results)
+    assert manager.refresh_future is None
+
+    # The next caller starts a fresh refresh instead of reusing the failed one
+    assert await manager.get_token() == "mock_token_2"
+    assert credential.calls == 2
+    assert manager.refresh_future is None
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_get_token_cancelled_waiter_does_not_cancel_refresh():
+    credential = MockAzureCredential()
+    credential.release.clear()
+    manager = TokenManager(credential, "scope")
+    cancelled = asyncio.create_task(manager.get_token())
+    waiter = asyncio.create_task(manager.get_token())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    credential.release.set()
+    assert await waiter == "mock_token_1"
+    assert cancelled.cancelled()
+    assert credential.calls == 1
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_on_refresh_receives_token():
+    received = []
+    manager = TokenManager(MockAzureCredential(), "scope", on_refresh=received.append)
+    await manager.get_token()
+    assert received == ["mock_token_1"]
+    await manager.close()
+
+
+async def wait_for_calls(credential, calls):
+    async def poll():
+        while credential.calls < calls:
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout=5)
+
+
+def create_fast_token_manager(credential, **kwargs):
+    manager = TokenManager(credential, "scope", **kwargs)
+    manager.refresh_margin = 1
+    manager.retry_delay = 0.05
+    return manager
+
+
+@pytest.mark.asyncio
+async def test_auto_refresh_fetches_first_token_immediately():
+    credential = MockAzureCredential()
+    manager = create_fast_token_manager(credential)
+    manager.start_auto_refresh()
+    await wait_for_calls(credential, 1)
+    await asyncio.sleep(0)
+    assert manager.is_valid(manager.min_validity)
+    # Requests reuse the token fetched in the background
+    assert await manager.get_token() == "mock_token_1"
+    assert credential.calls == 1
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_auto_refresh_refreshes_before_expiry():
+    received = []
+    # Tokens are within refresh_margin of expiry as soon as they are issued
+    credential = MockAzureCredential(lifetime=1)
+    manager = create_fast_token_manager(credential, on_refresh=received.append)
+    manager.start_auto_refresh()
+    await wait_for_calls(credential, 3)
+    await asyncio.sleep(0)
+    assert received[:3] == ["mock_token_1", "mock_token_2", "mock_token_3"]
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_auto_refresh_retries_after_failure():
+    credential = MockAzureCredential(fail_times=1)
+    manager = create_fast_token_manager(credential)
+    manager.start_auto_refresh()
+    await wait_for_calls(credential, 2)
+    await asyncio.sleep(0)
+    assert manager.cached_token is not None
+    assert manager.cached_token.token == "mock_token_2"
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_close_cancels_auto_refresh():
+    manager = create_fast_token_manager(MockAzureCredential())
+    manager.start_auto_refresh()
+    refresh_task = manager.refresh_task
+    await manager.close()
+    assert refresh_task is not None and refresh_task.cancelled()
+    assert manager.refresh_task is None